@@ -2,19 +2,31 @@ import os
 import logging
 import json
 import asyncio
+import math
+import re
+import shutil
+import struct
 import tempfile
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import deque
 from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 from dotenv import load_dotenv
 
 # Updated imports for modern telegram bot
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+from telegram.helpers import escape_markdown
 from telegram.ext import (
     Application,
+    ApplicationHandlerStop,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
     ConversationHandler,
+    TypeHandler,
     filters,
     ContextTypes
 )
@@ -23,6 +35,7 @@ from telegram.ext import (
 import yt_dlp
 import aiohttp
 from pathlib import Path
+from urllib.parse import quote
 
 # Load environment variables
 load_dotenv()
@@ -39,10 +52,101 @@ logger = logging.getLogger(__name__)
 # Global variables
 user_messages = {}
 banned_users = set()
+temp_bans = {}  # user_id -> ban expiry timestamp
 music_queue = []
 group_settings = {}
 welcome_messages = {}
-user_limits = {}  # Rate limiting
+welcome_templates = {}  # chat_id -> compiled welcome template
+pending_welcomes = {}  # chat_id -> joins waiting to be greeted
+plays_since_snapshot = 0
+user_limits = {}  # Rate limiting: user_id -> recent request times
+rate_limit_notified = {}  # user_id -> when we last told them to slow down
+dropped_updates = {'banned': 0, 'rate_limited': 0}
+bans_mtime = 0.0
+bans_checked = 0.0
+active_transcodes = 0  # Downloads/transcodes currently running
+
+# Pre-dispatch filtering
+RATE_LIMIT_WINDOW = 10  # Seconds
+RATE_LIMIT_MESSAGES = 5  # Requests allowed per window
+BANS_FILE = 'banned_users.json'
+BAN_RELOAD_INTERVAL = 5  # Seconds between checks for an edited bans file
+BAN_DURATION_UNITS = {'m': 60, 'h': 3600, 'd': 86400}
+
+# Audio quality profiles: name -> yt-dlp settings
+# Telegram's sendAudio only plays MP3 and M4A, so every profile produces one
+# 'codec' None means passthrough (send the source m4a stream as-is)
+AUDIO_PROFILES = {
+    'mp3-192': {'codec': 'mp3', 'quality': '192', 'label': 'MP3 192kbps'},
+    'mp3-128': {'codec': 'mp3', 'quality': '128', 'label': 'MP3 128kbps'},
+    'aac-96': {'codec': 'm4a', 'quality': '96', 'label': 'AAC 96kbps'},
+    'passthrough': {'codec': None, 'quality': None, 'label': 'Passthrough (no transcode)'},
+}
+DEFAULT_AUDIO_PROFILE = 'mp3-192'
+PASSTHROUGH_FALLBACK_QUALITY = '96'  # kbps when a passthrough source isn't m4a
+ADAPTIVE_PROFILE = 'adaptive'
+# Adaptive mode steps down this ladder as load goes up
+ADAPTIVE_LADDER = ['mp3-192', 'mp3-128', 'aac-96', 'passthrough']
+ADAPTIVE_BACKLOG_STEP = 3  # Queued/running transcodes per step down
+ADAPTIVE_LONG_TRACK = 600  # Tracks longer than this (seconds) step down once more
+ADAPTIVE_BUSY_LOAD = 0.8  # Load per CPU that steps down once more
+ADAPTIVE_SATURATED_LOAD = 1.5  # Load per CPU that skips transcoding entirely
+
+# Transcoded audio cache, one file per (video id, profile)
+AUDIO_CACHE_DIR = Path('audio_cache')
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_MB', '500')) * 1024 * 1024
+
+# Welcome greetings
+DEFAULT_WELCOME_MESSAGE = "👋 Welcome to the group, {name}!"
+WELCOME_BATCH_WINDOW = 5  # Seconds to coalesce joins into one greeting
+WELCOME_MAX_NAMES = 10  # Names listed per greeting, the rest are counted
+WELCOME_PLACEHOLDERS = {'name', 'mention', 'username', 'count', 'chat'}
+WELCOME_PLACEHOLDER_RE = re.compile(r'\{(\w+)\}')
+
+# Play history analytics
+PLAY_LOG_FILE = 'play_history.bin'  # Append-only binary log of delivered tracks
+ANALYTICS_FILE = 'analytics.json'  # Aggregate snapshot + log offset it covers
+# timestamp, user_id, chat_id, duration, latency_ms, cache_hit, video id length
+PLAY_RECORD = struct.Struct('<IqqHIBB')
+ANALYTICS_SNAPSHOT_EVERY = 20  # Plays between aggregate snapshots
+TOP_TRACKS = 10  # Size of the maintained top-track lists
+TRENDING_HALF_LIFE = 6 * 3600  # Seconds for a play's trending weight to halve
+PREWARM_INTERVAL = 30 * 60  # Seconds between audio cache pre-warm runs
+PREWARM_TRACKS = 5  # Trending tracks kept warm in the audio cache
+
+def new_play_stats() -> dict:
+    return {
+        'log_offset': 0,
+        'plays': 0,
+        'cache_hits': 0,
+        'latency_ms': 0,
+        'tracks': {},  # video_id -> {'title', 'url', 'profile', 'plays'}
+        'chats': {},  # chat_id -> {'plays', 'tracks': {video_id: plays}, 'top': [video_id]}
+        'users': {},  # user_id -> {'plays', 'seconds', 'cache_hits', 'last_played', 'tracks', 'favourite'}
+        'hourly': {},  # hour start timestamp -> plays, last 24 hours only
+        'trend_epoch': 0,
+        'trend_scores': {},  # video_id -> decayed play score relative to trend_epoch
+        'trending': [],  # video_ids ordered by trend score
+    }
+
+play_stats = new_play_stats()
+
+# Lyrics
+LYRICS_CACHE_FILE = 'lyrics_cache.jsonl'  # Append-only, later lines win
+LYRICS_DIR = os.getenv('LYRICS_DIR', 'lyrics')  # "Artist - Title.txt" files
+LYRICS_API_URL = 'https://api.lyrics.ovh/v1/{artist}/{title}'
+LYRICS_SUGGEST_URL = 'https://api.lyrics.ovh/suggest/{query}'  # Search, for queries without an artist
+LYRICS_MISS_TTL = 24 * 3600  # Seconds before a failed lookup is retried
+LYRICS_MATCH_THRESHOLD = 0.6  # Minimum title similarity for a fuzzy hit
+LYRICS_ARTIST_MISMATCH = 0.5  # Score factor when both artists are known and differ
+LYRICS_ARTIST_UNKNOWN = 0.75  # Score factor when only one side has an artist
+LYRICS_PAGE_SIZE = 3500  # Characters per page, under Telegram's 4096 limit
+LYRICS_NOISE = re.compile(
+    r'[\(\[][^\)\]]*(official|video|audio|lyric|visuali[sz]er|\bhd\b|\bhq\b|\b4k\b|remaster|\bfeat|\bft\b)[^\)\]]*[\)\]]',
+    re.IGNORECASE
+)
+LYRICS_FEAT = re.compile(r'\s(feat|ft|featuring)\b.*$', re.IGNORECASE)
+LYRICS_ARTIST_SUFFIX = re.compile(r'(vevo|\s-\stopic|\sofficial)$', re.IGNORECASE)
 
 # Conversation states
 WAITING_WELCOME = 1
@@ -51,20 +155,16 @@ WAITING_WELCOME = 1
 
 def check_rate_limit(user_id: int) -> bool:
     """Check if user has exceeded rate limit"""
-    now = datetime.now()
+    now = time.monotonic()
     if user_id not in user_limits:
-        user_limits[user_id] = []
-    
-    # Remove old entries
-    user_limits[user_id] = [
-        timestamp for timestamp in user_limits[user_id]
-        if now - timestamp < timedelta(seconds=RATE_LIMIT_WINDOW)
-    ]
+        user_limits[user_id] = deque(maxlen=RATE_LIMIT_MESSAGES)
     
-    if len(user_limits[user_id]) >= RATE_LIMIT_MESSAGES:
+    # Only the oldest of the last RATE_LIMIT_MESSAGES requests matters
+    timestamps = user_limits[user_id]
+    if len(timestamps) == RATE_LIMIT_MESSAGES and now - timestamps[0] < RATE_LIMIT_WINDOW:
         return False
     
-    user_limits[user_id].append(now)
+    timestamps.append(now)
     return True
 
 def is_admin(user_id: int, chat_id: int) -> bool:
@@ -73,6 +173,715 @@ def is_admin(user_id: int, chat_id: int) -> bool:
         return True
     return chat_id in group_settings and user_id in group_settings[chat_id].get('admins', [])
 
+# ====================== PRE-DISPATCH FILTER ======================
+
+def is_banned(user_id: int) -> bool:
+    """Check permanent and unexpired temporary bans"""
+    if user_id in banned_users:
+        return True
+    expiry = temp_bans.get(user_id)
+    if expiry is None:
+        return False
+    if expiry > time.time():
+        return True
+    del temp_bans[user_id]
+    return False
+
+def parse_ban_duration(text: str) -> Optional[int]:
+    """Parse durations like 30m, 12h or 7d into seconds"""
+    unit = BAN_DURATION_UNITS.get(text[-1:].lower())
+    if not unit or not text[:-1].isdigit():
+        return None
+    return int(text[:-1]) * unit
+
+def save_bans():
+    global bans_mtime
+    try:
+        data = {
+            'banned': sorted(banned_users),
+            'temporary': {str(user_id): expiry for user_id, expiry in temp_bans.items()}
+        }
+        # Write then rename so a hot reload never sees a half-written file
+        with open(BANS_FILE + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(BANS_FILE + '.tmp', BANS_FILE)
+        bans_mtime = os.path.getmtime(BANS_FILE)
+    except Exception as e:
+        logger.error(f"Error saving bans: {e}")
+
+def load_bans():
+    global bans_mtime
+    try:
+        mtime = os.path.getmtime(BANS_FILE)
+        with open(BANS_FILE) as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        if banned_users:
+            save_bans()  # Migrate bans stored in group_data.json
+        return
+    except (OSError, json.JSONDecodeError) as e:
+        logger.error(f"Error loading bans: {e}")
+        return
+    
+    # The file may be hand-edited, so coerce ids and skip anything malformed
+    now = time.time()
+    banned_users.clear()
+    for user_id in data.get('banned', []):
+        try:
+            banned_users.add(int(user_id))
+        except (TypeError, ValueError):
+            logger.error(f"Skipping invalid banned user id: {user_id!r}")
+    temp_bans.clear()
+    for user_id, expiry in data.get('temporary', {}).items():
+        try:
+            user_id, expiry = int(user_id), float(expiry)
+        except (TypeError, ValueError):
+            logger.error(f"Skipping invalid temporary ban: {user_id!r}: {expiry!r}")
+            continue
+        if expiry > now:
+            temp_bans[user_id] = expiry
+    bans_mtime = mtime
+    logger.info(f"Bans loaded: {len(banned_users)} permanent, {len(temp_bans)} temporary.")
+
+def reload_bans_if_changed():
+    """Pick up edits to the bans file, checking at most every BAN_RELOAD_INTERVAL"""
+    global bans_checked
+    now = time.monotonic()
+    if now - bans_checked < BAN_RELOAD_INTERVAL:
+        return
+    bans_checked = now
+    try:
+        if os.path.getmtime(BANS_FILE) != bans_mtime:
+            load_bans()
+    except OSError:
+        pass
+
+async def pre_dispatch_filter(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Drop updates from banned or over-limit users before any handler runs"""
+    user = update.effective_user
+    if not user or user.id == ADMIN_ID:
+        return
+    
+    reload_bans_if_changed()
+    if is_banned(user.id):
+        dropped_updates['banned'] += 1
+        raise ApplicationHandlerStop
+    
+    # Only rate limit things that make the bot do work
+    message = update.message
+    if not update.callback_query and not (message and message.text):
+        return
+    if check_rate_limit(user.id):
+        return
+    
+    dropped_updates['rate_limited'] += 1
+    # Tell the user once per window, not once per dropped update
+    now = time.monotonic()
+    if now - rate_limit_notified.get(user.id, 0) >= RATE_LIMIT_WINDOW:
+        rate_limit_notified[user.id] = now
+        if update.callback_query:
+            # Unanswered queries leave the button spinning on the client
+            await update.callback_query.answer("⏰ Slow down")
+        else:
+            await message.reply_text("⏰ Please wait before sending another command.")
+    raise ApplicationHandlerStop
+
+# ====================== AUDIO PROFILES ======================
+
+def get_system_load() -> float:
+    """Return 1-minute load average per CPU (0.0 where unsupported)"""
+    try:
+        return os.getloadavg()[0] / (os.cpu_count() or 1)
+    except (AttributeError, OSError):
+        return 0.0
+
+def resolve_audio_profile(chat_id: int, duration: int = 0) -> str:
+    """Pick the audio profile for a chat, applying adaptive step-down"""
+    profile = group_settings.get(chat_id, {}).get('audio_profile', DEFAULT_AUDIO_PROFILE)
+    if profile in AUDIO_PROFILES:
+        return profile
+    if profile != ADAPTIVE_PROFILE:
+        return DEFAULT_AUDIO_PROFILE
+
+    backlog = len(music_queue) + active_transcodes
+    step = backlog // ADAPTIVE_BACKLOG_STEP
+    load = get_system_load()
+    if load >= ADAPTIVE_SATURATED_LOAD:
+        step = len(ADAPTIVE_LADDER) - 1  # Box is saturated, skip transcoding
+    elif load >= ADAPTIVE_BUSY_LOAD:
+        step += 1
+    if duration and duration > ADAPTIVE_LONG_TRACK:
+        step += 1
+    return ADAPTIVE_LADDER[min(step, len(ADAPTIVE_LADDER) - 1)]
+
+def build_ydl_opts(profile: str, outtmpl: str) -> dict:
+    """Build yt-dlp download options for an audio profile"""
+    settings = AUDIO_PROFILES[profile]
+    ydl_opts = {
+        'outtmpl': outtmpl,
+        'quiet': True,
+        'no_warnings': True,
+        'updatetime': False  # Keep download time as mtime for LRU eviction
+    }
+    if settings['codec']:
+        ydl_opts['format'] = 'bestaudio/best'
+        ydl_opts['postprocessors'] = [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': settings['codec'],
+            'preferredquality': settings['quality'],
+        }]
+    else:
+        # Prefer the m4a stream as-is; FFmpegExtractAudio skips files already
+        # in the target format and only converts a webm/opus fallback to m4a
+        ydl_opts['format'] = 'bestaudio[ext=m4a]/bestaudio/best'
+        ydl_opts['postprocessors'] = [{
+            'key': 'FFmpegExtractAudio',
+            'preferredcodec': 'm4a',
+            'preferredquality': PASSTHROUGH_FALLBACK_QUALITY,
+        }]
+    return ydl_opts
+
+def get_cached_audio(video_id: str, profile: str) -> Optional[Path]:
+    """Return the cached file for a track/profile, if any"""
+    matches = list(AUDIO_CACHE_DIR.glob(f"{video_id}.{profile}.*"))
+    if not matches:
+        return None
+    matches[0].touch()  # Bump mtime for LRU eviction
+    return matches[0]
+
+def get_cached_adaptive_audio(video_id: str) -> Tuple[Optional[Path], Optional[str]]:
+    """Return the best-quality cached file on the adaptive ladder, if any"""
+    for profile in ADAPTIVE_LADDER:
+        cached = get_cached_audio(video_id, profile)
+        if cached:
+            return cached, profile
+    return None, None
+
+def store_cached_audio(video_id: str, profile: str, audio_file: Path) -> Path:
+    """Move a downloaded file into the cache and evict old entries"""
+    AUDIO_CACHE_DIR.mkdir(exist_ok=True)
+    cached = AUDIO_CACHE_DIR / f"{video_id}.{profile}{audio_file.suffix}"
+    shutil.move(str(audio_file), cached)
+    cached.touch()  # Newest entry, whatever mtime the download carried
+
+    entries = sorted(AUDIO_CACHE_DIR.iterdir(), key=lambda f: f.stat().st_mtime)
+    total = sum(f.stat().st_size for f in entries)
+    for entry in entries:
+        if total <= AUDIO_CACHE_MAX_BYTES or entry == cached:
+            continue
+        total -= entry.stat().st_size
+        entry.unlink()
+    return cached
+
+async def fetch_audio(video_info: dict, profile: str) -> Tuple[Optional[Path], bool]:
+    """Return (file, cache hit) for the track, downloading it if needed"""
+    global active_transcodes
+    video_id = video_info['id']
+    cached = get_cached_audio(video_id, profile)
+    if cached:
+        return cached, True
+
+    temp_dir = tempfile.mkdtemp()
+    active_transcodes += 1
+    try:
+        ydl_opts = build_ydl_opts(profile, os.path.join(temp_dir, f"{video_id}.%(ext)s"))
+
+        def download():
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                ydl.download([video_info['webpage_url']])
+
+        # Run in a thread so a long transcode doesn't block other updates
+        await asyncio.to_thread(download)
+
+        downloaded_files = [f for f in Path(temp_dir).iterdir() if f.is_file()]
+        if not downloaded_files:
+            return None, False
+        return store_cached_audio(video_id, profile, downloaded_files[0]), False
+    finally:
+        active_transcodes -= 1
+        try:
+            shutil.rmtree(temp_dir)
+        except Exception as e: # Catch any exception during cleanup
+            logger.error(f"Error cleaning up temp directory {temp_dir}: {e}") # Log cleanup errors
+
+# ====================== WELCOME TEMPLATES ======================
+
+def compile_welcome_template(text: str) -> List[tuple]:
+    """Split a welcome message into (literal, placeholder) parts once.
+
+    Literal text is kept as the admin wrote it (Markdown allowed). Only
+    known {placeholders} are recognized, any other braces stay verbatim.
+    """
+    parts = []
+    position = 0
+    for match in WELCOME_PLACEHOLDER_RE.finditer(text):
+        if match.group(1) not in WELCOME_PLACEHOLDERS:
+            continue
+        parts.append((text[position:match.start()], match.group(1)))
+        position = match.end()
+    parts.append((text[position:], None))
+    return parts
+
+def join_names(names: List[str], extra: int = 0) -> str:
+    """Join names as 'a, b and c' (or 'a, b and 3 others')"""
+    if extra:
+        return f"{', '.join(names)} and {extra} {'other' if extra == 1 else 'others'}"
+    if len(names) == 1:
+        return names[0]
+    return f"{', '.join(names[:-1])} and {names[-1]}"
+
+def render_welcome(template: List[tuple], users: list, extra: int, chat_title: str,
+                   markdown: bool = True) -> str:
+    """Fill a compiled template for a batch of new members.
+
+    With markdown=False values are left unescaped and mentions are plain
+    names, for the plain-text fallback.
+    """
+    escape = escape_markdown if markdown else (lambda text: text)
+    if markdown:
+        # Escapes don't work inside link text, so drop the brackets instead
+        mentions = [
+            f"[{u.first_name.replace('[', '').replace(']', '')}](tg://user?id={u.id})" for u in users
+        ]
+    else:
+        mentions = [u.first_name for u in users]
+    values = {
+        'name': join_names([escape(u.first_name) for u in users], extra),
+        'mention': join_names(mentions, extra),
+        'username': join_names(
+            [escape(f"@{u.username}" if u.username else u.first_name) for u in users], extra
+        ),
+        'count': str(len(users) + extra),
+        'chat': escape(chat_title or ''),
+    }
+    return ''.join(literal + (values[field] if field else '') for literal, field in template)
+
+def get_welcome_template(chat_id: int) -> List[tuple]:
+    """Return the compiled template for a chat"""
+    if chat_id not in welcome_templates:
+        message = welcome_messages.get(chat_id, DEFAULT_WELCOME_MESSAGE)
+        welcome_templates[chat_id] = compile_welcome_template(message)
+    return welcome_templates[chat_id]
+
+# ====================== PLAY ANALYTICS ======================
+
+def update_top(top: List[str], scores: dict, video_id: str, size: int = TOP_TRACKS):
+    """Keep a small ordered top list current after video_id's score went up"""
+    if video_id not in top:
+        if len(top) >= size and scores[video_id] <= scores[top[-1]]:
+            return
+        top.append(video_id)
+    top.sort(key=lambda vid: scores[vid], reverse=True)
+    del top[size:]
+
+def apply_play(record: tuple, meta: Optional[dict] = None):
+    """Fold one delivered track into the aggregates"""
+    timestamp, user_id, chat_id, video_id, duration, latency_ms, cache_hit = record
+    stats = play_stats
+    stats['plays'] += 1
+    stats['cache_hits'] += cache_hit
+    stats['latency_ms'] += latency_ms
+
+    track = stats['tracks'].setdefault(video_id, {'title': video_id, 'url': None, 'profile': None, 'plays': 0})
+    track['plays'] += 1
+    if meta:
+        track.update(meta)
+
+    chat = stats['chats'].setdefault(str(chat_id), {'plays': 0, 'tracks': {}, 'top': []})
+    chat['plays'] += 1
+    chat['tracks'][video_id] = chat['tracks'].get(video_id, 0) + 1
+    update_top(chat['top'], chat['tracks'], video_id)
+
+    user = stats['users'].setdefault(str(user_id), {
+        'plays': 0, 'seconds': 0, 'cache_hits': 0, 'last_played': 0, 'tracks': {}, 'favourite': None
+    })
+    user['plays'] += 1
+    user['seconds'] += duration
+    user['cache_hits'] += cache_hit
+    user['last_played'] = timestamp
+    user['tracks'][video_id] = user['tracks'].get(video_id, 0) + 1
+    favourite = user['favourite']
+    if favourite is None or user['tracks'][video_id] > user['tracks'][favourite]:
+        user['favourite'] = video_id
+
+    # Rolling 24h volume, one bucket per hour
+    hour = timestamp - timestamp % 3600
+    if str(hour) not in stats['hourly']:
+        for bucket in [b for b in stats['hourly'] if int(b) <= hour - 24 * 3600]:
+            del stats['hourly'][bucket]
+    stats['hourly'][str(hour)] = stats['hourly'].get(str(hour), 0) + 1
+
+    # Trending: each play weighs 2^((t - epoch) / half-life), so older plays
+    # fade relative to new ones without touching every score on each play
+    if not stats['trend_epoch']:
+        stats['trend_epoch'] = timestamp
+    exponent = (timestamp - stats['trend_epoch']) / TRENDING_HALF_LIFE
+    if exponent > 64:
+        # Rebase before the weights overflow
+        scale = math.pow(2, -exponent)
+        stats['trend_scores'] = {
+            vid: score * scale for vid, score in stats['trend_scores'].items() if score * scale > 1e-6
+        }
+        stats['trending'] = [vid for vid in stats['trending'] if vid in stats['trend_scores']]
+        stats['trend_epoch'] = timestamp
+        exponent = 0
+    scores = stats['trend_scores']
+    scores[video_id] = scores.get(video_id, 0) + math.pow(2, exponent)
+    update_top(stats['trending'], scores, video_id)
+
+def hourly_volume() -> List[Tuple[int, int]]:
+    """Return (hour start, plays) for the last 24 hours, oldest first"""
+    now = int(time.time())
+    current_hour = now - now % 3600
+    hourly = play_stats['hourly']
+    for bucket in [b for b in hourly if int(b) <= current_hour - 24 * 3600]:
+        del hourly[bucket]
+    return [
+        (hour, hourly.get(str(hour), 0))
+        for hour in range(current_hour - 23 * 3600, current_hour + 3600, 3600)
+    ]
+
+def encode_play(record: tuple) -> bytes:
+    timestamp, user_id, chat_id, video_id, duration, latency_ms, cache_hit = record
+    video_id = video_id.encode()[:255]
+    return PLAY_RECORD.pack(
+        timestamp, user_id, chat_id, min(duration, 0xFFFF), min(latency_ms, 0xFFFFFFFF),
+        int(cache_hit), len(video_id)
+    ) + video_id
+
+def read_plays(offset: int = 0):
+    """Yield (record, end offset) from the play log starting at offset"""
+    with open(PLAY_LOG_FILE, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(PLAY_RECORD.size)
+            if len(header) < PLAY_RECORD.size:
+                return  # End of log (or a torn final write)
+            try:
+                timestamp, user_id, chat_id, duration, latency_ms, cache_hit, id_len = PLAY_RECORD.unpack(header)
+                video_id = f.read(id_len)
+                if len(video_id) < id_len:
+                    return
+                video_id = video_id.decode()
+            except (struct.error, UnicodeDecodeError):
+                return  # Garbage from a torn write, treat as end of log
+            offset += PLAY_RECORD.size + id_len
+            yield (timestamp, user_id, chat_id, video_id, duration, latency_ms, cache_hit), offset
+
+def record_play(song: dict, profile: str, latency_ms: int, cache_hit: bool):
+    """Append a delivered track to the play log and update aggregates"""
+    global plays_since_snapshot
+    info = song['info']
+    record = (
+        int(time.time()), song['requested_by'], song['chat_id'], info['id'],
+        int(song['duration'] or 0), int(latency_ms), int(cache_hit)
+    )
+    try:
+        with open(PLAY_LOG_FILE, 'ab') as f:
+            f.write(encode_play(record))
+            play_stats['log_offset'] = f.tell()
+    except Exception as e:
+        logger.error(f"Error writing play log: {e}")
+    apply_play(record, {'title': song['title'], 'url': info.get('webpage_url'), 'profile': profile})
+
+    plays_since_snapshot += 1
+    if plays_since_snapshot >= ANALYTICS_SNAPSHOT_EVERY:
+        save_analytics()
+
+def save_analytics():
+    global plays_since_snapshot
+    try:
+        # Write then rename so a crash mid-write keeps the previous snapshot
+        with open(ANALYTICS_FILE + '.tmp', 'w') as f:
+            json.dump(play_stats, f)
+        os.replace(ANALYTICS_FILE + '.tmp', ANALYTICS_FILE)
+        plays_since_snapshot = 0
+    except Exception as e:
+        logger.error(f"Error saving analytics: {e}")
+
+def load_analytics():
+    """Load the aggregate snapshot and replay log records written after it"""
+    try:
+        with open(ANALYTICS_FILE) as f:
+            play_stats.update(json.load(f))
+    except (FileNotFoundError, json.JSONDecodeError):
+        play_stats.update(new_play_stats())
+
+    replayed = 0
+    try:
+        for record, offset in read_plays(play_stats['log_offset']):
+            apply_play(record)
+            play_stats['log_offset'] = offset
+            replayed += 1
+    except FileNotFoundError:
+        pass
+    
+    # Cut off any torn final record so new appends stay aligned
+    try:
+        if os.path.getsize(PLAY_LOG_FILE) > play_stats['log_offset']:
+            os.truncate(PLAY_LOG_FILE, play_stats['log_offset'])
+            logger.info(f"Truncated play log to {play_stats['log_offset']} bytes.")
+    except OSError:
+        pass
+    logger.info(f"Analytics loaded: {play_stats['plays']} plays ({replayed} replayed from log).")
+
+async def prewarm_audio_cache():
+    """Periodically download trending tracks so their next play is a cache hit"""
+    while True:
+        await asyncio.sleep(PREWARM_INTERVAL)
+        for video_id in play_stats['trending'][:PREWARM_TRACKS]:
+            track = play_stats['tracks'].get(video_id, {})
+            profile = track.get('profile')
+            if not track.get('url') or profile not in AUDIO_PROFILES:
+                continue
+            if get_cached_audio(video_id, profile):
+                continue
+            if music_queue or active_transcodes or get_system_load() >= ADAPTIVE_BUSY_LOAD:
+                break  # Never compete with real requests
+            try:
+                await fetch_audio({'id': video_id, 'webpage_url': track['url']}, profile)
+                logger.info(f"Pre-warmed {video_id} ({profile})")
+            except Exception as e:
+                logger.error(f"Pre-warm error for {video_id}: {e}")
+
+# ====================== LYRICS ======================
+
+def normalize_title(text: str) -> str:
+    """Lowercase a title and drop '(Official Video)', 'ft. X' and punctuation"""
+    text = LYRICS_NOISE.sub(' ', text)
+    text = LYRICS_FEAT.sub('', text)
+    text = re.sub(r'[^\w\s]', ' ', text.lower())
+    return ' '.join(text.split())
+
+def normalize_artist(text: str) -> str:
+    """Normalize an artist/uploader name ('EdSheeranVEVO' -> 'edsheeran')"""
+    text = LYRICS_ARTIST_SUFFIX.sub('', text.strip())
+    return re.sub(r'[^\w]', '', LYRICS_FEAT.sub('', text).lower())
+
+def split_track_title(title: str, uploader: str = '') -> Tuple[str, str]:
+    """Guess (artist, title) from a YouTube title like 'Artist - Song (Official Video)'"""
+    parts = re.split(r'\s[-–—]\s', title, maxsplit=1)
+    if len(parts) == 2:
+        return parts[0], parts[1]
+    return uploader, title
+
+def lyrics_key(artist: str, title: str) -> str:
+    return f"{normalize_artist(artist)}|{normalize_title(title)}"
+
+class LyricsIndex:
+    """Normalized artist/title keys with a token index for fuzzy lookups"""
+    
+    def __init__(self):
+        self.entries = {}  # key -> value
+        self.tokens = {}  # title token -> keys containing it
+        self.ids = {}  # short id (for callback data) -> key
+    
+    def add(self, key: str, value, fuzzy: bool = True):
+        """Store value under key; only fuzzy entries can match title variants"""
+        self.entries[key] = value
+        self.ids[f"{zlib.crc32(key.encode()):08x}"] = key
+        for token in key.split('|', 1)[1].split():
+            if fuzzy:
+                self.tokens.setdefault(token, set()).add(key)
+            elif token in self.tokens:
+                self.tokens[token].discard(key)
+    
+    def find(self, artist: str, title: str) -> Optional[str]:
+        """Return the exact key or the closest title variant, if close enough"""
+        key = lyrics_key(artist, title)
+        if key in self.entries:
+            return key
+        return self.closest(artist, title)
+    
+    def closest(self, artist: str, title: str) -> Optional[str]:
+        """Return the best fuzzy match among entries added with fuzzy=True"""
+        artist, title = lyrics_key(artist, title).split('|', 1)
+        wanted = set(title.split())
+        candidates = set()
+        for token in wanted:
+            candidates.update(self.tokens.get(token, ()))
+        
+        best, best_score = None, LYRICS_MATCH_THRESHOLD
+        for candidate in candidates:
+            candidate_artist, candidate_title = candidate.split('|', 1)
+            have = set(candidate_title.split())
+            score = len(wanted & have) / len(wanted | have)
+            if artist and candidate_artist:
+                # A known, different artist makes a title match much less likely
+                if artist not in candidate_artist and candidate_artist not in artist:
+                    score *= LYRICS_ARTIST_MISMATCH
+            elif artist or candidate_artist:
+                score *= LYRICS_ARTIST_UNKNOWN
+            if score >= best_score:
+                best, best_score = candidate, score
+        return best
+
+class LyricsProvider(ABC):
+    """Source of lyrics, tried in order until one returns text"""
+    name = 'base'
+    
+    @abstractmethod
+    async def fetch(self, artist: str, title: str) -> Optional[str]:
+        """Return lyrics for the song, or None if this provider has none"""
+
+class LocalLyricsProvider(LyricsProvider):
+    """Reads 'Artist - Title.txt' files from a directory (useful offline)"""
+    name = 'local'
+    
+    def __init__(self, directory: str):
+        self.directory = Path(directory)
+        self.index = None
+    
+    async def fetch(self, artist: str, title: str) -> Optional[str]:
+        if self.index is None:
+            self.index = LyricsIndex()
+            if self.directory.is_dir():
+                for path in self.directory.glob('*.txt'):
+                    file_artist, file_title = split_track_title(path.stem)
+                    self.index.add(lyrics_key(file_artist, file_title), path)
+        
+        key = self.index.find(artist, title)
+        if not key:
+            return None
+        return self.index.entries[key].read_text(encoding='utf-8')
+
+class LyricsOvhProvider(LyricsProvider):
+    """Looks lyrics up on lyrics.ovh, searching for the artist if it's missing"""
+    name = 'lyrics.ovh'
+    
+    async def fetch(self, artist: str, title: str) -> Optional[str]:
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
+            if not artist:
+                async with session.get(LYRICS_SUGGEST_URL.format(query=quote(title, safe=''))) as response:
+                    if response.status != 200:
+                        return None
+                    results = (await response.json()).get('data') or []
+                if not results:
+                    return None
+                artist, title = results[0]['artist']['name'], results[0]['title']
+            
+            url = LYRICS_API_URL.format(artist=quote(artist, safe=''), title=quote(title, safe=''))
+            async with session.get(url) as response:
+                if response.status != 200:
+                    return None
+                data = await response.json()
+                return data.get('lyrics') or None
+
+lyrics_providers = [LocalLyricsProvider(LYRICS_DIR), LyricsOvhProvider()]
+lyrics_cache = LyricsIndex()
+lyrics_inflight = {}  # key -> task, so concurrent requests share one lookup
+
+def load_lyrics_cache():
+    try:
+        with open(LYRICS_CACHE_FILE, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # Torn final write
+                lyrics_cache.add(entry.pop('key'), entry, fuzzy=bool(entry['lyrics']))
+        logger.info(f"Lyrics cache loaded: {len(lyrics_cache.entries)} entries.")
+    except FileNotFoundError:
+        pass
+
+def store_lyrics(key: str, entry: dict):
+    # Misses are only reused for the exact query, never for title variants
+    lyrics_cache.add(key, entry, fuzzy=bool(entry['lyrics']))
+    try:
+        with open(LYRICS_CACHE_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'key': key, **entry}) + '\n')
+    except Exception as e:
+        logger.error(f"Error saving lyrics cache: {e}")
+
+async def fetch_lyrics(key: str, artist: str, title: str) -> dict:
+    """Ask each provider in turn and cache the result.
+
+    A miss is only cached when every provider answered; if any of them
+    failed (network down, timeout, 5xx) the next request tries again.
+    """
+    artist = LYRICS_ARTIST_SUFFIX.sub('', LYRICS_FEAT.sub('', artist.strip()))
+    title = LYRICS_FEAT.sub('', LYRICS_NOISE.sub('', title)).strip()
+    entry = {'artist': artist, 'title': title, 'lyrics': None, 'source': None, 'time': int(time.time())}
+    failed = False
+    for provider in lyrics_providers:
+        try:
+            text = await provider.fetch(artist, title)
+        except Exception as e:
+            logger.error(f"Lyrics provider {provider.name} error: {e}")
+            failed = True
+            continue
+        if text:
+            entry['lyrics'], entry['source'] = text.strip(), provider.name
+            break
+    if entry['lyrics'] or not failed:
+        store_lyrics(key, entry)
+    return entry
+
+async def find_lyrics(artist: str, title: str) -> Tuple[str, dict]:
+    """Return (cache key, entry), serving repeat lookups from the local cache"""
+    key = lyrics_key(artist, title)
+    entry = lyrics_cache.entries.get(key)
+    if entry and entry['lyrics']:
+        return key, entry
+    
+    # Misses are never fuzzy-indexed, so a close match always has lyrics
+    match = lyrics_cache.closest(artist, title)
+    if match:
+        return match, lyrics_cache.entries[match]
+    if entry and time.time() - entry['time'] < LYRICS_MISS_TTL:
+        return key, entry
+    
+    if key not in lyrics_inflight:
+        lyrics_inflight[key] = asyncio.ensure_future(fetch_lyrics(key, artist, title))
+    try:
+        return key, await lyrics_inflight[key]
+    finally:
+        lyrics_inflight.pop(key, None)
+
+def paginate_lyrics(text: str, size: int = LYRICS_PAGE_SIZE) -> List[str]:
+    """Split lyrics into pages, breaking between stanzas, then lines, where possible"""
+    # (separator before piece, piece): stanzas, or lines of oversized stanzas
+    pieces = []
+    for stanza in text.split('\n\n'):
+        if len(stanza) <= size:
+            pieces.append(('\n\n', stanza))
+            continue
+        separator = '\n\n'
+        for line in stanza.split('\n'):
+            # Only a single line that still doesn't fit gets cut mid-line
+            for i in range(0, max(len(line), 1), size):
+                pieces.append((separator, line[i:i + size]))
+                separator = ''
+            separator = '\n'
+    
+    pages, current = [], ''
+    for separator, piece in pieces:
+        if current and len(current) + len(separator) + len(piece) > size:
+            pages.append(current)
+            current = piece
+        else:
+            current = current + separator + piece if current else piece
+    if current:
+        pages.append(current)
+    return pages or ['']
+
+def render_lyrics_page(key: str, entry: dict, page: int) -> Tuple[str, Optional[InlineKeyboardMarkup]]:
+    pages = paginate_lyrics(entry['lyrics'])
+    page = max(0, min(page, len(pages) - 1))
+    heading = f"{entry['title']} - {entry['artist']}" if entry['artist'] else entry['title']
+    text = f"🎤 {heading}\n\n{pages[page]}"
+    if len(pages) == 1:
+        return text, None
+    
+    short_id = f"{zlib.crc32(key.encode()):08x}"
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️ Prev", callback_data=f'lyrics_{short_id}_{page - 1}'))
+    buttons.append(InlineKeyboardButton(f"{page + 1}/{len(pages)}", callback_data=f'lyrics_{short_id}_{page}'))
+    if page < len(pages) - 1:
+        buttons.append(InlineKeyboardButton("Next ▶️", callback_data=f'lyrics_{short_id}_{page + 1}'))
+    return text, InlineKeyboardMarkup([buttons])
+
 # ====================== CORE FUNCTIONS ======================
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -87,11 +896,13 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 🎶 *Available Commands:*
 
 🔊 *Music:*
-/play <song> - Play a song (192kbps HQ)
+/play <song> - Play a song (quality set in /settings)
 /search <song> - Search for songs
 /queue - Show current playlist
 /skip - Skip current song
 /clear - Clear playlist
+/lyrics [artist - song] - Lyrics (defaults to the current song)
+/mystats - Your listening stats
 
 👥 *Group Management:*
 /setup - Initialize bot in group
@@ -103,10 +914,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /reply <user_id> <msg> - Reply to user (Admin only)
 
 ⚙️ *Admin Only:*
-/ban <user_id> - Ban user
+/ban <user_id> [30m|12h|7d] - Ban user (optionally for a while)
 /unban <user_id> - Unban user
 /broadcast <msg> - Send to all users
 /stats - Show bot statistics
+/trending - Trending songs and play analytics
     """
     await update.message.reply_text(help_text, parse_mode='Markdown')
 
@@ -116,15 +928,6 @@ async def play_music(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
     
-    # Check bans and rate limits
-    if user_id in banned_users:
-        await update.message.reply_text("🚫 You are banned from using this bot.")
-        return
-    
-    if not check_rate_limit(user_id):
-        await update.message.reply_text("⏰ Please wait before sending another command.")
-        return
-    
     # Check if music is enabled in group
     if chat_id < 0:  # Group chat
         if chat_id not in group_settings or not group_settings[chat_id].get('music_enabled', True):
@@ -210,7 +1013,6 @@ async def send_music(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
         
     current_song = music_queue[0]
-    temp_dir = tempfile.mkdtemp()
     
     try:
         # Send "downloading" message
@@ -219,29 +1021,20 @@ async def send_music(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text="⬇️ Downloading song..."
         )
         
-        # Download with yt-dlp
-        ydl_opts = {
-            'format': 'bestaudio/best',
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
-            'outtmpl': os.path.join(temp_dir, '%(title)s.%(ext)s'),
-            'quiet': True,
-            'no_warnings': True
-        }
-        
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([current_song['info']['webpage_url']])
-        
-        # Find the downloaded file
-        downloaded_files = list(Path(temp_dir).glob('*.mp3'))
-        if not downloaded_files:
+        started = time.monotonic()
+        audio_file, profile = None, None
+        chat_profile = group_settings.get(current_song['chat_id'], {}).get('audio_profile')
+        if chat_profile == ADAPTIVE_PROFILE:
+            # Any rung already cached beats transcoding again under load
+            audio_file, profile = get_cached_adaptive_audio(current_song['info']['id'])
+        if audio_file:
+            cache_hit = True
+        else:
+            profile = resolve_audio_profile(current_song['chat_id'], current_song['duration'])
+            audio_file, cache_hit = await fetch_audio(current_song['info'], profile)
+        if not audio_file:
             await downloading_msg.edit_text("❌ Download failed")
             return
-            
-        audio_file = downloaded_files[0]
         
         # Check file size (50MB limit)
         if audio_file.stat().st_size > 50 * 1024 * 1024:
@@ -262,6 +1055,7 @@ async def send_music(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         
         await downloading_msg.delete()
+        record_play(current_song, profile, int((time.monotonic() - started) * 1000), cache_hit)
         
         # Remove from queue and play next
         music_queue.pop(0)
@@ -279,21 +1073,8 @@ async def send_music(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text=f"❌ Playback error: {str(e)}"
         )
         logger.error(f"Playback error: {str(e)}")
-    finally:
-        # Cleanup temp files
-        try:
-            import shutil
-            shutil.rmtree(temp_dir)
-        except Exception as e: # Catch any exception during cleanup
-            logger.error(f"Error cleaning up temp directory {temp_dir}: {e}") # Log cleanup errors
 
 async def search_music(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = update.message.from_user.id
-    
-    if user_id in banned_users:
-        await update.message.reply_text("🚫 You are banned from using this bot.")
-        return
-    
     if not context.args:
         await update.message.reply_text("Please specify a search query after /search")
         return
@@ -392,13 +1173,75 @@ async def remove_song(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("`remove_song` command not yet implemented.")
 
 async def lyrics_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("`lyrics_search` command not yet implemented.")
+    chat_id = update.message.chat.id
+    
+    if context.args:
+        artist, title = split_track_title(' '.join(context.args))
+    else:
+        # Default to the song currently playing in this chat
+        current_song = next((song for song in music_queue if song['chat_id'] == chat_id), None)
+        if not current_song:
+            await update.message.reply_text(
+                "Please specify a song after /lyrics\nExample: `/lyrics Rick Astley - Never Gonna Give You Up`",
+                parse_mode='Markdown'
+            )
+            return
+        artist, title = split_track_title(current_song['title'], current_song['uploader'])
+    
+    match = lyrics_cache.find(artist, title)
+    searching_msg = None
+    if not match:
+        searching_msg = await update.message.reply_text("🔍 Searching for lyrics...")
+    
+    try:
+        key, entry = await find_lyrics(artist, title)
+    except Exception as e:
+        logger.error(f"Lyrics error: {str(e)}")
+        entry = None
+    
+    if not entry or not entry['lyrics']:
+        text, reply_markup = f"❌ No lyrics found for {title}", None
+    else:
+        text, reply_markup = render_lyrics_page(key, entry, 0)
+    
+    if searching_msg:
+        await searching_msg.edit_text(text, reply_markup=reply_markup)
+    else:
+        await update.message.reply_text(text, reply_markup=reply_markup)
+
+async def handle_lyrics_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    _, short_id, page = query.data.split('_')
+    key = lyrics_cache.ids.get(short_id)
+    entry = lyrics_cache.entries.get(key)
+    if not entry or not entry['lyrics']:
+        await query.answer("❌ These lyrics are no longer available")
+        return
+    
+    await query.answer()
+    text, reply_markup = render_lyrics_page(key, entry, int(page))
+    if text != query.message.text:
+        await query.edit_message_text(text, reply_markup=reply_markup)
 
 async def set_volume(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("`set_volume` command not yet implemented.")
 
 async def user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("`user_stats` command not yet implemented.")
+    user = update.message.from_user
+    stats = play_stats['users'].get(str(user.id))
+    if not stats:
+        await update.message.reply_text("📊 You haven't played any songs yet. Try /play!")
+        return
+    
+    favourite = play_stats['tracks'].get(stats['favourite'], {}).get('title', stats['favourite'])
+    last_played = datetime.fromtimestamp(stats['last_played']).strftime('%Y-%m-%d %H:%M')
+    await update.message.reply_text(
+        f"📊 Stats for {user.first_name}:\n\n"
+        f"🎵 Songs played: {stats['plays']}\n"
+        f"⏱️ Listening time: {stats['seconds'] // 3600}h {stats['seconds'] % 3600 // 60}m\n"
+        f"❤️ Favourite: {favourite} ({stats['tracks'][stats['favourite']]} plays)\n"
+        f"🕒 Last played: {last_played}"
+    )
 
 
 # ====================== GROUP MANAGEMENT ======================
@@ -441,10 +1284,12 @@ async def group_settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
     settings = group_settings[chat_id]
     music_status = "🔊 ON" if settings['music_enabled'] else "🔇 OFF"
     welcome_status = "✅ ON" if settings['welcome_enabled'] else "❌ OFF"
+    audio_profile = settings.get('audio_profile', DEFAULT_AUDIO_PROFILE)
     
     keyboard = [
         [InlineKeyboardButton(f"Music: {music_status}", callback_data=f'toggle_music_{chat_id}')],
         [InlineKeyboardButton(f"Welcome: {welcome_status}", callback_data=f'toggle_welcome_{chat_id}')],
+        [InlineKeyboardButton(f"🎚️ Audio: {audio_profile}", callback_data=f'audio_profiles_{chat_id}')],
         [InlineKeyboardButton("👥 Admin List", callback_data=f'admin_list_{chat_id}')],
         [InlineKeyboardButton("🔧 Set Welcome Message", callback_data=f'set_welcome_{chat_id}')]
     ]
@@ -454,6 +1299,7 @@ async def group_settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
         "⚙️ **Group Settings:**\n\n"
         f"🎵 Music: {music_status}\n"
         f"👋 Welcome: {welcome_status}\n"
+        f"🎚️ Audio: {audio_profile}\n"
         f"👥 Admins: {len(settings['admins'])}",
         reply_markup=reply_markup,
         parse_mode='Markdown'
@@ -461,13 +1307,17 @@ async def group_settings_menu(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    
     data = query.data.split('_')
     action = data[0]
     feature = data[1]
     chat_id = int(data[2])
     
+    # The audio profile drives CPU cost, so only admins may change it
+    if action in ('audio', 'profile') and not is_admin(query.from_user.id, chat_id):
+        await query.answer("❌ Only admins can change the audio profile", show_alert=True)
+        return
+    await query.answer()
+    
     if action == 'toggle':
         if feature == 'music':
             group_settings[chat_id]['music_enabled'] = not group_settings[chat_id]['music_enabled']
@@ -483,6 +1333,33 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
         admin_list = "\n".join([f"• {admin_id}" for admin_id in admins])
         await query.edit_message_text(f"👥 **Group Admins:**\n{admin_list}", parse_mode='Markdown')
     
+    elif action == 'audio' and feature == 'profiles':
+        current = group_settings[chat_id].get('audio_profile', DEFAULT_AUDIO_PROFILE)
+        keyboard = [
+            [InlineKeyboardButton(
+                f"{'✅ ' if name == current else ''}{settings['label']}",
+                callback_data=f'profile_set_{chat_id}_{name}'
+            )]
+            for name, settings in AUDIO_PROFILES.items()
+        ]
+        keyboard.append([InlineKeyboardButton(
+            f"{'✅ ' if current == ADAPTIVE_PROFILE else ''}Adaptive (step down under load)",
+            callback_data=f'profile_set_{chat_id}_{ADAPTIVE_PROFILE}'
+        )])
+        await query.edit_message_text(
+            "🎚️ Choose the audio profile for this group:",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+        return
+    
+    elif action == 'profile' and feature == 'set':
+        profile = data[3]
+        if profile not in AUDIO_PROFILES and profile != ADAPTIVE_PROFILE:
+            await query.edit_message_text("❌ Unknown audio profile")
+            return
+        group_settings[chat_id]['audio_profile'] = profile
+        await query.edit_message_text(f"🎚️ Audio profile is now {profile}")
+    
     elif action == 'set' and feature == 'welcome':
         # Store context for the conversation handler
         context.user_data['setting_welcome_for_chat_id'] = chat_id
@@ -494,36 +1371,59 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
 async def set_welcome_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = context.user_data.get('setting_welcome_for_chat_id', update.message.chat.id) # Use stored chat_id
     welcome_messages[chat_id] = update.message.text
+    welcome_templates[chat_id] = compile_welcome_template(update.message.text)
     group_settings[chat_id]['welcome_enabled'] = True
     await save_group_data()
-    await update.message.reply_text("✅ Welcome message set!")
+    await update.message.reply_text(
+        "✅ Welcome message set!\n"
+        "Placeholders: {name}, {mention}, {username}, {count}, {chat}"
+    )
     return ConversationHandler.END
 
 async def welcome_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat.id
     if chat_id in group_settings and group_settings[chat_id]['welcome_enabled']:
-        for user in update.message.new_chat_members:
-            if user.id == context.bot.id:
-                continue  # Skip bot's own join
-            message = welcome_messages.get(chat_id, "👋 Welcome to the group, {name}!")
-            await update.message.reply_text(
-                message.replace("{name}", user.first_name),
-                parse_mode='Markdown'
+        users = [user for user in update.message.new_chat_members if user.id != context.bot.id]
+        if not users:
+            return  # Skip bot's own join
+        
+        # Coalesce joins in a short window into one greeting
+        if chat_id not in pending_welcomes:
+            pending_welcomes[chat_id] = {'users': [], 'extra': 0}
+            context.application.create_task(
+                flush_welcomes(chat_id, update.message.chat.title, context)
             )
+        pending = pending_welcomes[chat_id]
+        for user in users:
+            if len(pending['users']) < WELCOME_MAX_NAMES:
+                pending['users'].append(user)
+            else:
+                pending['extra'] += 1
+
+async def flush_welcomes(chat_id: int, chat_title: str, context: ContextTypes.DEFAULT_TYPE):
+    """Send one greeting for every join collected during the batch window"""
+    await asyncio.sleep(WELCOME_BATCH_WINDOW)
+    pending = pending_welcomes.pop(chat_id, None)
+    if not pending or not pending['users']:
+        return
+    
+    template = get_welcome_template(chat_id)
+    message = render_welcome(template, pending['users'], pending['extra'], chat_title)
+    try:
+        await context.bot.send_message(chat_id=chat_id, text=message, parse_mode='Markdown')
+    except BadRequest as e:
+        # The admin's Markdown may be malformed, fall back to plain text
+        logger.error(f"Welcome message Markdown error in {chat_id}: {e}")
+        message = render_welcome(template, pending['users'], pending['extra'], chat_title, markdown=False)
+        await context.bot.send_message(chat_id=chat_id, text=message)
+    except Exception as e:
+        logger.error(f"Failed to send welcome message to {chat_id}: {e}")
 
 # ====================== ADMIN FUNCTIONS ======================
 
 async def forward_to_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.message.from_user
     
-    if user.id in banned_users:
-        await update.message.reply_text("🚫 You are banned from using this bot.")
-        return
-    
-    if not check_rate_limit(user.id):
-        await update.message.reply_text("⏰ Please wait before sending another message.")
-        return
-    
     user_messages[user.id] = {
         'username': user.username or user.first_name,
         'chat_id': update.message.chat_id,
@@ -575,15 +1475,29 @@ async def ban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if not context.args:
-        await update.message.reply_text("Usage: `/ban <user_id>`", parse_mode='Markdown')
+        await update.message.reply_text("Usage: `/ban <user_id> [30m|12h|7d]`", parse_mode='Markdown')
         return
     
     try:
         user_id = int(context.args[0])
-        banned_users.add(user_id)
-        await update.message.reply_text(f"🚫 User {user_id} has been banned.")
     except ValueError:
         await update.message.reply_text("❌ Invalid user ID.")
+        return
+    
+    if len(context.args) > 1:
+        duration = parse_ban_duration(context.args[1])
+        if not duration:
+            await update.message.reply_text("❌ Invalid duration. Use e.g. 30m, 12h or 7d.")
+            return
+        banned_users.discard(user_id)
+        temp_bans[user_id] = time.time() + duration
+        save_bans()
+        await update.message.reply_text(f"🚫 User {user_id} has been banned for {context.args[1]}.")
+    else:
+        temp_bans.pop(user_id, None)
+        banned_users.add(user_id)
+        save_bans()
+        await update.message.reply_text(f"🚫 User {user_id} has been banned.")
 
 async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.from_user.id != ADMIN_ID:
@@ -597,6 +1511,8 @@ async def unban_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user_id = int(context.args[0])
         banned_users.discard(user_id)
+        temp_bans.pop(user_id, None)
+        save_bans()
         await update.message.reply_text(f"✅ User {user_id} has been unbanned.")
     except ValueError:
         await update.message.reply_text("❌ Invalid user ID.")
@@ -635,21 +1551,54 @@ async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
 📊 **Bot Statistics:**
 
 👥 **Users:** {len(user_messages)}
-🚫 **Banned Users:** {len(banned_users)}
+🚫 **Banned Users:** {len(banned_users)} (+{len(temp_bans)} temporary)
+🛡️ **Dropped Updates:** {dropped_updates['banned']} banned, {dropped_updates['rate_limited']} rate limited
 💬 **Groups:** {len(group_settings)}
 🎵 **Queue Length:** {len(music_queue)}
+🎧 **Songs Played:** {play_stats['plays']}
 👋 **Welcome Messages:** {len(welcome_messages)}
     """
     await update.message.reply_text(stats, parse_mode='Markdown')
 
+async def show_trending(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.message.from_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Admin only command!")
+        return
+    
+    tracks = play_stats['tracks']
+    trending = "\n".join(
+        f"{i}. {tracks[vid]['title']} ({tracks[vid]['plays']} plays)"
+        for i, vid in enumerate(play_stats['trending'], 1)
+    ) or "No plays yet"
+    
+    chat_stats = play_stats['chats'].get(str(update.message.chat.id))
+    chat_top = "\n".join(
+        f"{i}. {tracks[vid]['title']} ({chat_stats['tracks'][vid]} plays)"
+        for i, vid in enumerate(chat_stats['top'][:5], 1)
+    ) if chat_stats else "No plays in this chat yet"
+    
+    hours = [f"{datetime.fromtimestamp(hour).strftime('%H')}h {plays}" for hour, plays in hourly_volume()]
+    hourly = "\n".join(" | ".join(hours[i:i + 6]) for i in range(0, 24, 6))
+    plays = play_stats['plays']
+    hit_rate = play_stats['cache_hits'] * 100 // plays if plays else 0
+    avg_latency = play_stats['latency_ms'] / plays / 1000 if plays else 0
+    
+    await update.message.reply_text(
+        f"🔥 Trending now:\n{trending}\n\n"
+        f"💬 Top in this chat:\n{chat_top}\n\n"
+        f"📈 Plays per hour (last 24h):\n{hourly}\n\n"
+        f"🎵 Total plays: {plays}\n"
+        f"💾 Cache hit rate: {hit_rate}%\n"
+        f"⚡ Avg delivery time: {avg_latency:.1f}s"
+    )
+
 # ====================== DATA MANAGEMENT ======================
 
 async def save_group_data():
     try:
         data = {
             'settings': group_settings,
-            'welcome': welcome_messages,
-            'banned_users': list(banned_users)
+            'welcome': welcome_messages
         }
         # Render's filesystem is ephemeral for free tiers, but group_data.json
         # will persist across deployments. However, if the service restarts,
@@ -666,7 +1615,9 @@ async def load_group_data():
             data = json.load(f)
             group_settings.update(data.get('settings', {}))
             welcome_messages.update(data.get('welcome', {}))
-            banned_users.update(data.get('banned_users', []))
+            for chat_id, message in welcome_messages.items():
+                welcome_templates[chat_id] = compile_welcome_template(message)
+            banned_users.update(data.get('banned_users', []))  # Legacy, now in BANS_FILE
         logger.info("Existing data loaded successfully.")
     except (FileNotFoundError, json.JSONDecodeError):
         logger.info("No existing data file found or file is empty/corrupt, starting fresh.")
@@ -684,12 +1635,19 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ====================== MAIN ======================
 
+async def post_init(application: Application):
+    """Start background tasks once the application is initialized"""
+    application.create_task(prewarm_audio_cache())
+
 async def main():
     """Start the bot."""
     await load_group_data()
+    load_bans()
+    load_analytics()
+    load_lyrics_cache()
     
     # Create the Application
-    application = Application.builder().token(TOKEN).build()
+    application = Application.builder().token(TOKEN).post_init(post_init).build()
     
     # Conversation handler for welcome messages
     conv_handler = ConversationHandler(
@@ -702,6 +1660,9 @@ async def main():
         ]
     )
     
+    # Ban and rate limit filter, runs before every other handler group
+    application.add_handler(TypeHandler(Update, pre_dispatch_filter), group=-1)
+    
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
@@ -730,9 +1691,11 @@ async def main():
     application.add_handler(CommandHandler("unban", unban_user))
     application.add_handler(CommandHandler("broadcast", broadcast_message))
     application.add_handler(CommandHandler("stats", show_stats))
+    application.add_handler(CommandHandler("trending", show_trending))
     
     # Other handlers
     application.add_handler(conv_handler)
+    application.add_handler(CallbackQueryHandler(handle_lyrics_callback, pattern='^lyrics_'))
     application.add_handler(CallbackQueryHandler(handle_settings_callback))
     application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, welcome_new_member))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, forward_to_admin)) 
@@ -749,6 +1712,7 @@ async def main():
     finally:
         # Explicitly stop the application. This helps clean up resources.
         logger.info("Bot is shutting down gracefully...")
+        save_analytics()
         await application.stop()
         logger.info("Bot application stopped.")
 